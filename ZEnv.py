@@ -1,16 +1,15 @@
 import os
-import platform
-import json
+import re
+import fnmatch
+import logging
 from enum import Enum
-from pathlib import Path
 
-# SCons imports
+from typing import TYPE_CHECKING
 
-import SCons
-import SCons.Script as Script
-from SCons.Script import Variables, BoolVariable, EnumVariable, Environment, Tool, Configure
-# Lib imports
-from . import utils
+# SCons imports
+# Only used for type hints, so the module can be imported without SCons.
+if TYPE_CHECKING:
+    from SCons.Script import Variables, Environment
 
 class CompilerType(Enum):
     # Argument style: -whatever
@@ -21,10 +20,150 @@ class CompilerType(Enum):
     # Examples: clang-cl, MSVC
     MSVC_COMPATIBLE = 2
 
+def _walkSuffix(root: str, suffix: str):
+    """
+    Recursively yields the files under root ending with suffix. Equivalent
+    to Path(root).glob("**/*" + suffix), but uses os.scandir directly; the
+    DirEntry already knows whether it's a directory, and no Path objects
+    are created. Output follows the same order as pathlib, and like pathlib,
+    directories ending with suffix are included too.
+
+    Unlike pathlib, hidden directories (such as .git) aren't descended into,
+    and symlinked directories aren't followed.
+    """
+    root = os.path.normpath(root)
+    suffix = os.path.normcase(suffix)
+    # "." is left out of the output paths, like pathlib does
+    stack = ["" if root == "." else root]
+    while stack:
+        directory = stack.pop()
+        subdirectories = []
+        try:
+            with os.scandir(directory or ".") as entries:
+                for entry in entries:
+                    path = os.path.join(directory, entry.name)
+                    if entry.is_dir(follow_symlinks = False) and not entry.name.startswith("."):
+                        subdirectories.append(path)
+                    if os.path.normcase(entry.name).endswith(suffix):
+                        yield path
+        except OSError:
+            continue
+        # Reversed, so the first subdirectory is the next one popped
+        stack.extend(reversed(subdirectories))
+
+# Glob component -> compiled matcher, shared by every CGlob call
+_PATTERN_CACHE = {}
+
+def _compilePattern(part: str):
+    """
+    Returns a function matching names against the glob component part. Case
+    sensitivity follows the platform, like fnmatch.fnmatch.
+    """
+    matcher = _PATTERN_CACHE.get(part)
+    if matcher is None:
+        matcher = _PATTERN_CACHE[part] = re.compile(fnmatch.translate(os.path.normcase(part))).match
+    return matcher
+
+def _walkPattern(root: str, pattern: str):
+    """
+    Lists the paths under root matching a glob pattern, with the same
+    semantics as Path(root).glob(pattern): components are matched with
+    fnmatch, and ** matches any number of directories, including none.
+    Like _walkSuffix, ** doesn't descend into hidden directories, or
+    follow symlinked directories.
+    """
+    root = os.path.normpath(root)
+    parts = [part for part in pattern.split("/") if part not in ("", ".")]
+    # As with pathlib, a trailing slash only matches directories
+    dirsOnly = pattern.endswith("/")
+    found = {}
+    # (directory, index of the next pattern component)
+    pending = [("" if root == "." else root, 0)]
+    while pending:
+        directory, index = pending.pop()
+        if index == len(parts):
+            found.setdefault(directory or ".", None)
+            continue
+        part = parts[index]
+        if part == "**":
+            pending.append((directory, index + 1))
+            try:
+                with os.scandir(directory or ".") as entries:
+                    for entry in entries:
+                        # Symlinked directories aren't followed, so loops can't recurse forever
+                        if entry.is_dir(follow_symlinks = False) and not entry.name.startswith("."):
+                            pending.append((os.path.join(directory, entry.name), index))
+            except OSError:
+                pass
+            continue
+        last = index + 1 == len(parts)
+        if not any(c in part for c in "*?["):
+            # Nothing to match, so there's no need to list the directory
+            path = os.path.join(directory, part)
+            if os.path.exists(path) if last and not dirsOnly else os.path.isdir(path):
+                pending.append((path, index + 1))
+            continue
+        match = _compilePattern(part)
+        try:
+            with os.scandir(directory or ".") as entries:
+                for entry in entries:
+                    if match(os.path.normcase(entry.name)) and (last and not dirsOnly or entry.is_dir()):
+                        pending.append((os.path.join(directory, entry.name), index + 1))
+        except OSError:
+            pass
+    return sorted(found)
+
+def _walkGlob(root: str, pattern: str):
+    """
+    Returns an iterator over the paths under root matching pattern.
+    """
+    # The common **/*.<ext> case doesn't need any pattern matching. **/* isn't
+    # included, as it matches directories too
+    suffix = pattern[4:]
+    if pattern.startswith("**/*") and suffix and not any(c in suffix for c in "*?[/"):
+        return _walkSuffix(root, suffix)
+    return iter(_walkPattern(root, pattern))
+
+# Used for warnings. Without any logging configuration, these still end up on stderr.
+_log = logging.getLogger(__name__)
+
+# Where Program and the Library variants put their output, relative to the variant dir
+_BIN = "bin/"
+
+# (absolute sourceDir, pattern, sourceDir mtime) -> CGlob result.
+# The mtime only changes when sourceDir's own entries change; hosts that keep
+# the process alive across source changes should call ZEnv.clearGlobCache()
+_GLOB_CACHE = {}
+
+# (conanfile, install folder) -> the conanfile's mtime when it was last checked in this process
+_CONAN_MTIME_CACHE = {}
+
+# The Conan API, created by _getConan() the first time an install is needed
+_CONAN_API = None
+
+def _getConan():
+    """
+    Returns the Conan API, importing Conan and creating it the first time
+    it's called. Conan is a heavy import, and most builds never need it.
+    """
+    global _CONAN_API
+    if _CONAN_API is None:
+        if "CUSTOM_CONAN" in os.environ:
+            # Utility for Conan versions installed from source
+            import sys
+            sys.path.append(os.environ["CUSTOM_CONAN"])
+
+        from conans.client.conan_api import ConanAPIV1 as conan_api
+        _CONAN_API, _, _ = conan_api.factory()
+    return _CONAN_API
+
 class ZEnv:
+    # Every attribute ZEnv has. Anything else is forwarded to the environment
+    __slots__ = ("environment", "path", "debug", "compiler", "argType", "variables",
+                 "sanitizers", "libraries", "compilerFlags", "variantDir", "stdlib", "_visitedScripts")
 
-    def __init__(self, environment: Environment, path: str, debug: bool, compiler: str, argType: CompilerType,
-                 variables: Variables):
+    def __init__(self, environment: "Environment", path: str, debug: bool, compiler: str, argType: CompilerType,
+                 variables: "Variables"):
         self.environment = environment;
         self.path = path;
         self.debug = debug;
@@ -32,8 +171,6 @@ class ZEnv:
         self.argType = argType;
         self.variables = variables;
 
-        self.sourceFlags = environment["CXXFLAGS"]
-
         self.sanitizers = []
         self.libraries = []
         self.compilerFlags = []
@@ -41,17 +178,40 @@ class ZEnv:
 
         self.stdlib = None
 
+        # (script, variant dir) -> (exports, other kwargs, what SConscript returned) for it
+        self._visitedScripts = {}
+
+    @property
+    def sourceFlags(self):
+        """
+        The environment's CXXFLAGS. Looked up on access, so environments that never
+        read it don't pay for it.
+        """
+        return self.environment["CXXFLAGS"]
+
+    def _emit(self, kind: str, name: str, sources, **kwargs):
+        """
+        Calls the SCons builder named by kind, with the output placed in bin/
+        """
+        return getattr(self.environment, kind)(_BIN + name, sources, **kwargs)
+
     def Program(self, name: str, sources, **kwargs):
-        return self.environment.Program("bin/" + name, sources, **kwargs)
+        return self._emit("Program", name, sources, **kwargs)
 
     def Library(self, name: str, sources, **kwargs):
-        return self.environment.Library("bin/" + name, sources, **kwargs)
+        return self._emit("Library", name, sources, **kwargs)
 
     def SharedLibrary(self, name: str, sources, **kwargs):
-        return self.environment.SharedLibrary("bin/" + name, sources, **kwargs)
+        return self._emit("SharedLibrary", name, sources, **kwargs)
 
     def StaticLibrary(self, name: str, sources, **kwargs):
-        return self.environment.StaticLibrary("bin/" + name, sources, **kwargs)
+        return self._emit("StaticLibrary", name, sources, **kwargs)
+
+    def subpath(self, *names):
+        """
+        Returns the given path components relative to the build directory.
+        """
+        return os.path.join(self.path, *names)
 
     def VariantDir(self, target: str, source: str, **kwargs):
         self.environment.VariantDir(target, source)
@@ -60,7 +220,7 @@ class ZEnv:
         if source is None:
             # Used as a fallback to only type in once. Especially useful for lazy naming
             source = name
-        self.environment.VariantDir(os.path.join(self.path, name), source, **kwargs)
+        self.environment.VariantDir(self.subpath(name), source, **kwargs)
 
     def Glob(self, pattern, **kwargs):
         """
@@ -71,46 +231,81 @@ class ZEnv:
         This is a limitation of SCons, and one I'll
         have to figure out a workaround for Some Day:tm:
         """
+        # Not cached: SCons' Glob also returns targets declared since the last call
         return self.environment.Glob(pattern, **kwargs)
 
+    def _globKey(self, sourceDir, pattern):
+        root = os.path.abspath(sourceDir)
+        try:
+            mtime = os.stat(root).st_mtime_ns
+        except OSError:
+            mtime = None
+        return (root, pattern, mtime)
+
+    def iterGlob(self, sourceDir, pattern = "**/*.cpp"):
+        """
+        Like CGlob, but returns an iterator. For **/*.<ext> patterns that
+        haven't been globbed yet, paths are yielded as the tree is walked
+        rather than collected first. These results aren't cached.
+        """
+        cached = _GLOB_CACHE.get(self._globKey(sourceDir, pattern))
+        if cached is not None:
+            return iter(cached)
+        return _walkGlob(sourceDir, pattern)
+
     def CGlob(self, sourceDir, pattern = "**/*.cpp"):
-        paths = []
-        for path in Path(sourceDir).glob(pattern):
-            paths.append(str(path))
-        return paths
+        key = self._globKey(sourceDir, pattern)
+        if key not in _GLOB_CACHE:
+            _GLOB_CACHE[key] = list(_walkGlob(sourceDir, pattern))
+        # Copied, so callers are free to modify the list
+        return list(_GLOB_CACHE[key])
+
+    @staticmethod
+    def clearGlobCache():
+        """
+        Forgets every cached CGlob result.
+        """
+        _GLOB_CACHE.clear()
 
     def FlavorSConscript(self, flavorName, script, **kwargs):
-        return self.SConscript(os.path.join(self.path, flavorName, script), **kwargs)
+        return self.SConscript(self.subpath(flavorName, script), **kwargs)
 
-    def SConscript(self, script, variant_dir = None, **kwargs):
+    def _deriveVariantDir(self, script, variant_dir = None):
         if variant_dir is not None:
             # Patches the variant dir
-            variant_dir = os.path.join(self.path, variant_dir)
-        else:
-            # Automatic variant detection
-            r = script.rsplit("/", 1)
-            if (len(r) == 2):
-                variant_dir = os.path.join(self.path, r[0])
-            else:
-                variant_dir = self.path
+            return self.subpath(variant_dir)
+        # Automatic variant detection
+        # Also splits on backslashes on Windows
+        head = os.path.dirname(script)
+        return self.subpath(head) if head else self.path
+
+    def SConscript(self, script, variant_dir = None, **kwargs):
+        variant_dir = self._deriveVariantDir(script, variant_dir)
         self.variantDir = variant_dir
-        exports = {"env": self}
-        if "exports" in kwargs:
-            exports.update(kwargs["exports"])
-            del kwargs["exports"]
 
-        return self.environment.SConscript(script, exports = exports, variant_dir = variant_dir, **kwargs)
+        userExports = kwargs.pop("exports", None) or {}
+
+        # Exports and kwargs may not be hashable, so the calls for each script and variant dir
+        # are kept in a list, and compared with ==
+        previousCalls = self._visitedScripts.setdefault((script, variant_dir), [])
+        for previousExports, previousKwargs, result in previousCalls:
+            if previousExports == userExports and previousKwargs == kwargs:
+                # Reading it again would only declare the same targets again
+                _log.warning("%s has already been read into %s. Reusing the previous result", script, variant_dir)
+                return result
+
+        exports = {"env": self, **userExports}
+
+        result = self.environment.SConscript(script, exports = exports, variant_dir = variant_dir, **kwargs)
+        previousCalls.append((dict(userExports), dict(kwargs), result))
+        return result
 
     def withLibraries(self, libraries: list, append: bool = True):
         """
         Specifies libraries to link. Note that this should not be used for dependencies imported through conan,
         as those are set when the import is handled.
         """
-        aLibs = []
-        if (type(libraries) is list):
-            aLibs = libraries
-        else:
-            aLibs.append(libraries)
+        aLibs = list(libraries) if isinstance(libraries, (list, tuple)) else [libraries]
 
         if append:
             self.environment.Append(LIBS = aLibs)
@@ -122,78 +317,88 @@ class ZEnv:
         Utility method for cross-environment stuff, like for cases where you
         have a Program depending on a Library
         """
-        return os.path.join((self.path if self.variantDir == "" else self.variantDir), "bin/")
-
-    def appendLibPath(self, libPath: str):
-        if type(libPath) is not str:
-            raise RuntimeError("You can only append strings, not " + str(type(libPath)))
-        self.environment.Append(LIBPATH = [libPath])
-
-    def appendSourcePath(self, sourcePath: str):
-        if type(sourcePath) is not str:
-            raise RuntimeError("You can only append strings, not " + str(type(sourcePath)))
-        self.environment.Append(CPPPATH = [sourcePath])
+        return os.path.join(self.variantDir or self.path, _BIN)
+
+    def appendLibPath(self, libPath: "str | os.PathLike"):
+        # Stripped when running Python with -O
+        if __debug__:
+            if not isinstance(libPath, (str, os.PathLike)):
+                raise RuntimeError("You can only append strings or paths, not " + str(type(libPath)))
+        self.environment.Append(LIBPATH = [os.fspath(libPath)])
+
+    def appendSourcePath(self, sourcePath: "str | os.PathLike"):
+        # Stripped when running Python with -O
+        if __debug__:
+            if not isinstance(sourcePath, (str, os.PathLike)):
+                raise RuntimeError("You can only append strings or paths, not " + str(type(sourcePath)))
+        self.environment.Append(CPPPATH = [os.fspath(sourcePath)])
 
     def withConan(self, conanfile: str = None, options: list = [], settings: list = [], remotes = []):
-        if options is None:
-            options = []
-        elif type(options) is str:
-            options = [options]
-
-        if settings is None:
-            settings = []
-        elif type(settings) is str:
-            settings = [settings]
+        options = [options] if isinstance(options, str) else list(options or [])
+        settings = [settings] if isinstance(settings, str) else list(settings or [])
+
+        cwd = os.getcwd()
+        buildDirectory = os.path.join(cwd, self.path)
+        os.makedirs(buildDirectory, exist_ok = True)
+
+        conanfilePath = conanfile or os.path.join(cwd, "conanfile.txt")
+        try:
+            lastMod = os.stat(conanfilePath).st_mtime
+        except FileNotFoundError:
+            conanfilePath = os.path.join(cwd, "conanfile.py")
+            # Allowed to raise if neither exists
+            lastMod = os.stat(conanfilePath).st_mtime
+        installKey = (conanfilePath, buildDirectory)
+        # Already checked (or installed) in this process
+        if _CONAN_MTIME_CACHE.get(installKey) != lastMod:
+            self._conanInstall(conanfilePath, buildDirectory, lastMod, options, settings, remotes)
+            _CONAN_MTIME_CACHE[installKey] = lastMod
 
-        if "CUSTOM_CONAN" in os.environ:
-            # Utility for Conan versions installed from source
-            import sys
-            sys.path.append(os.environ["CUSTOM_CONAN"])
-
-        from conans.client.conan_api import ConanAPIV1 as conan_api
-        from conans import __version__ as conan_version
+        conan = self.environment.SConscript(os.path.join(self.path, "SConscript_conan"))
 
-        conan, _, _ = conan_api.factory()
+        self.environment.MergeFlags(conan["conan"])
 
-        if type(remotes) == list and len(remotes) != 0:
-            for remote in remotes:
-                name = remote["remote_name"]
-                url = remote["url"]
+    def _conanInstall(self, conanfilePath: str, buildDirectory: str, lastMod: float, options: list,
+                      settings: list, remotes):
+        """
+        Runs conan install, unless the EnvMod.stamp says it's already been done for this
+        version of the conanfile. Conan itself is only imported if an install is needed,
+        which means unchanged trees don't pay for importing it.
+        """
+        # Holds the conanfile's modification time as of the last install, as a hex float
+        stampPath = os.path.join(self.path, "EnvMod.stamp")
+        try:
+            with open(stampPath, "r") as f:
+                modified = float.fromhex(f.read())
+        except (FileNotFoundError, ValueError):
+            modified = 0.0
+
+        if modified < lastMod:
+            conan = _getConan()
+
+            if isinstance(remotes, (list, tuple)) and len(remotes) != 0:
                 existingRemotes = conan.remote_list()
-
-                filterByUrl = [eRem for eRem in existingRemotes if eRem.url == url]
-                if len(filterByUrl) > 0:
-                    continue
-
-                filterByName = [eRem for eRem in existingRemotes if eRem.name.lower() == name.lower()]
-                if (len(filterByName) > 0):
-                    import random
-                    remote["remote_name"] = remote["remote_name"] + str(random.randint(0, 99999))
-
-                conan.remote_add(**remote)
-
-        buildDirectory = os.path.join(os.getcwd(), self.path)
-        if not os.path.exists(buildDirectory):
-            os.makedirs(buildDirectory)
-
-        data = {
-            "modified": 0
-        }
-        if os.path.isfile(os.path.join(self.path, "EnvMod.json")):
-            with open(os.path.join(self.path, "EnvMod.json"), "r") as f:
-                data = json.load(f)
-
-        conanfilePath = os.path.join(os.getcwd(), "conanfile.txt") if conanfile is None else conanfile
-        if not os.path.isfile(conanfilePath):
-            conanfilePath = os.path.join(os.getcwd(), "conanfile.py")
-
-        lastMod = os.path.getmtime(conanfilePath)
-        if data["modified"] < lastMod:
-            profile = self.environment["profile"] if "profile" in self.environment else "default"
-            if "settings" in self.environment:
-                settings = settings + self.environment["settings"].split(",")
-            if "options" in self.environment:
-                options = options + self.environment["options"].split(",")
+                knownUrls = {eRem.url for eRem in existingRemotes}
+                knownNames = {eRem.name.lower() for eRem in existingRemotes}
+                for remote in remotes:
+                    if remote["url"] in knownUrls:
+                        continue
+
+                    if remote["remote_name"].lower() in knownNames:
+                        import random
+                        remote["remote_name"] = remote["remote_name"] + str(random.randint(0, 99999))
+
+                    conan.remote_add(**remote)
+                    knownUrls.add(remote["url"])
+                    knownNames.add(remote["remote_name"].lower())
+
+            profile = self.environment.get("profile", "default")
+            envSettings = self.environment.get("settings")
+            if envSettings:
+                settings = settings + envSettings.split(",")
+            envOptions = self.environment.get("options")
+            if envOptions:
+                options = options + envOptions.split(",")
             conan.install(conanfilePath,
                     generators = ["scons"],
                     install_folder = buildDirectory,
@@ -201,13 +406,8 @@ class ZEnv:
                     settings = settings,
                     build = [ "missing" ],
                     profile_names = [ profile ])
-            data["modified"] = lastMod
-            with open(os.path.join(self.path, "EnvMod.json"), "w") as f:
-                json.dump(data, f)
-
-        conan = self.environment.SConscript(os.path.join(self.path, "SConscript_conan"))
-
-        self.environment.MergeFlags(conan["conan"])
+            with open(stampPath, "w") as f:
+                f.write(float(lastMod).hex())
 
     def withCompilationDB(self, output = "compile_commands.json"):
         """
@@ -224,11 +424,29 @@ class ZEnv:
         self.environment.Tool('compilation_db')
         return self.environment.CompilationDatabase(output)
 
+    def withCache(self, path: str = None):
+        """
+        Enables SCons' derived-file cache in path, falling back to the SCONS_CACHE
+        environment variable if path isn't supplied.
+
+        To only retrieve files from the cache without adding new ones (i.e. in CI),
+        run scons with --cache-readonly. It can't be set from an SConscript.
+
+        Returns whether or not a cache was enabled.
+        """
+        path = path or os.environ.get("SCONS_CACHE")
+        if not path:
+            print("NOTE: withCache() called without a path, and SCONS_CACHE isn't set. Not using a cache")
+            return False
+        self.environment.CacheDir(path)
+        return True
+
     # Configuration utilities
     def configure(self):
         """
         Returns a configuration context.
         """
+        from . import utils
         return utils.ConfigContext(self)
 
     def Clone(self, *args, **kwargs):
@@ -238,13 +456,15 @@ class ZEnv:
         Any args and/or kwargs are forwarded to the environment provided by SCons.
         These have no effect on the ZEnv, for various implementation reasons.
         """
-        newEnv = ZEnv(self.environment.Clone(*args, **kwargs), self.path, self.debug, self.compiler,
-                    self.argType, self.variables)
-        newEnv.sanitizers = self.sanitizers
-        newEnv.libraries = self.libraries
-        newEnv.compilerFlags = self.compilerFlags
-        newEnv.variantDir = self.variantDir
-        newEnv.stdlib = self.stdlib
+        newEnv = ZEnv.__new__(type(self))
+        for name in ZEnv.__slots__:
+            setattr(newEnv, name, getattr(self, name))
+        newEnv.environment = self.environment.Clone(*args, **kwargs)
+        newEnv._visitedScripts = {}
+        # Copied rather than shared, so changes to the clone don't leak into this environment
+        newEnv.sanitizers = self.sanitizers.copy()
+        newEnv.libraries = self.libraries.copy()
+        newEnv.compilerFlags = self.compilerFlags.copy()
         return newEnv
 
     def getEnvVar(self, key: str):
@@ -268,19 +488,16 @@ class ZEnv:
         Note that including all system variables may negatively affect SCons, and could
         potentially break compiling.
         """
-        if ("all" in kwargs and kwargs["all"] == True):
-            for key, value in os.environ.items():
-                # Skip registered keys.
-                if key in keys:
-                    continue
-
-                self.environment["ENV"][key] = value;
-            return;
+        ENV = self.environment["ENV"]
+        if kwargs.get("all", False):
+            # Skip registered keys.
+            exclude = frozenset(keys)
+            ENV.update((key, value) for key, value in os.environ.items() if key not in exclude)
+            return
         for key in keys:
-            try:
-                self.environment["ENV"][key] = os.environ[key]
-            except:
-                pass
+            value = os.environ.get(key)
+            if value is not None:
+                ENV[key] = value
 
     def isMSVC(self):
         return self.compiler == "msvc"
@@ -301,6 +518,9 @@ class ZEnv:
         return self.environment[item]
 
     def __getattr__(self, item):
-        if item in self.__dict__ or item in dir(self):
-            return getattr(self, item)
+        # Only called when regular lookup fails, so at this point the attribute
+        # isn't part of ZEnv. environment itself is excluded to avoid recursing
+        # before it's been assigned.
+        if item == "environment":
+            raise AttributeError(item)
         return getattr(self.environment, item)
@@ -1,18 +1,140 @@
 import os
-import platform
-import json
-from enum import Enum
-from pathlib import Path
+import sys
+import logging
+import functools
+import itertools
 
-# SCons imports
-
-import SCons
-import SCons.Script as Script
-from SCons.Script import Variables, BoolVariable, EnumVariable, Environment, Tool, Configure
 # Lib imports
-from . import utils
 from . import ZEnv as ZEnvFile
 
+# sys.platform is a constant, whereas platform.platform() has to query the OS
+# (uname on POSIX) every time it's called.
+_IS_WINDOWS = sys.platform == "win32"
+
+# Used for warnings. Without any logging configuration, these still end up on stderr.
+_log = logging.getLogger(__name__)
+
+# Values accepted as true in boolean environment variables (i.e. LUNASCONS_DEBUG)
+_TRUTHY = frozenset({"true", "1", "yes", "on"})
+
+def _envbool(name: str, default: bool = False):
+    """
+    Reads a boolean environment variable.
+    """
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in _TRUTHY
+
+# SCons imports
+# These are resolved lazily by __getattr__, so importing the module for
+# i.e. CompilerType or normalizeCompilerName doesn't drag in SCons.
+_SCONS_NAMES = ("Variables", "BoolVariable", "EnumVariable", "Environment", "Tool", "Configure")
+
+def __getattr__(name: str):
+    if name == "Script" or name in _SCONS_NAMES:
+        import SCons.Script as Script
+        globals()[name] = Script if name == "Script" else getattr(Script, name)
+        return globals()[name]
+    elif name == "utils":
+        # `from . import utils` would recurse back in here through hasattr
+        import importlib
+        return importlib.import_module(".utils", __name__)
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
+
+# Compiler launchers getEnvironment can prefix CXX/CC with, in order of preference.
+# They're skipped when detecting the compiler.
+_COMPILER_LAUNCHERS = ("ccache", "sccache")
+
+# Exact compiler names. Checked before the prefixes, which are only needed for
+# versioned or target-prefixed names such as g++-11.
+_COMPILER_ALIASES = {
+    "gcc": "gcc",
+    "g++": "gcc",
+    "clang": "clang",
+    "clang++": "clang",
+    "clang-cl": "clang-cl",
+    "msvc": "msvc",
+    "cl": "msvc",
+}
+
+# (prefix, normalized name) pairs, checked in order. More specific prefixes
+# have to come first; clang-cl would otherwise be caught by clang.
+_COMPILER_PREFIXES = (
+    ("clang-cl", "clang-cl"),
+    ("clang++", "clang"),
+    ("clang", "clang"),
+    ("g++", "gcc"),
+    ("gcc", "gcc"),
+    ("msvc", "msvc"),
+)
+
+# Compiler flags, by argument style and build type. Kept as tokens, so they
+# can be handed straight to env.Append without any string splitting.
+# -pipe passes intermediate output between the compiler stages in memory rather than temporary files
+_POSIX_BASE_FLAGS = ("-pedantic", "-Wall", "-Wextra", "-Wno-c++11-narrowing", "-pipe")
+_POSIX_DEBUG_FLAGS = ("-g", "-O0")
+_POSIX_RELEASE_FLAGS = ("-O3",)
+# Note to self: /W4 and /Wall spews out warnings for dependencies. Roughly equivalent to -Wall -Wextra on stereoids
+_MSVC_BASE_FLAGS = ("/W3", "/EHsc", "/FS")
+_MSVC_DEBUG_FLAGS = ("/Zi",)
+_MSVC_RELEASE_FLAGS = ("/O2",)
+
+def _buildFlags(argType, debug: bool, dynamic: bool, coverage: bool):
+    """
+    Returns the compile and link flags for a build configuration, apart from
+    the standard and sanitizers, which getEnvironment adds.
+    """
+    linkFlags = []
+    if (argType == ZEnvFile.CompilerType.POSIX):
+        compileFlags = [*_POSIX_BASE_FLAGS]
+        if debug:
+            compileFlags.extend(_POSIX_DEBUG_FLAGS)
+            if coverage:
+                compileFlags.append("--coverage")
+                linkFlags.append("--coverage")
+
+        else:
+            compileFlags.extend(_POSIX_RELEASE_FLAGS)
+    else:
+        compileFlags = [*_MSVC_BASE_FLAGS]
+        runtime = "/MT" if not dynamic else "/MD"
+        if debug:
+            linkFlags.append("/DEBUG")
+            compileFlags.extend([runtime + "d", *_MSVC_DEBUG_FLAGS])
+        else:
+            compileFlags.extend([*_MSVC_RELEASE_FLAGS, runtime])
+    return (tuple(compileFlags), tuple(linkFlags))
+
+# (argument style, debug, dynamic, coverage) -> (compile flags, link flags), for every configuration
+_FLAG_TABLE = {
+    key: _buildFlags(*key)
+    for key in itertools.product(ZEnvFile.CompilerType, (True, False), (True, False), (True, False))
+}
+
+@functools.lru_cache(maxsize = None)
+def _normalizeCompilerName(name: str):
+    """
+    normalizeCompilerName without the warning. Returns None if the compiler is unknown.
+    Cached, since it runs for every environment.
+    """
+    # Names are matched without the path or .exe, so i.e. C:\...\cl.exe is msvc,
+    # without a cl prefix catching clazy or cling as well. Backslashes are split on
+    # regardless of the platform, as CXX may come from a Windows-style config.
+    base = name.replace("\\", "/").rpartition("/")[2]
+    if base.lower().endswith(".exe"):
+        base = base[:-4]
+    normalized = _COMPILER_ALIASES.get(base)
+    if normalized is not None:
+        return normalized
+    for prefix, normalized in _COMPILER_PREFIXES:
+        if base.startswith(prefix):
+            return normalized
+    return None
+
+def _warnUnknownCompiler(name: str):
+    _log.warning("Unknown compiler detected (%s). Normalization failed. Usage of this compiler may have unintended side-effects.", name)
+
 def normalizeCompilerName(name: str):
     """
     This function attempts to normalize compiler inputs (through CXX)
@@ -24,16 +146,11 @@ def normalizeCompilerName(name: str):
 
     I'll rather add any other compilers here if necessary.
     """
-    if (name.startswith("gcc") or name.startswith("g++")):
-        return "gcc"
-    elif name.startswith("clang") or name.startswith("clang++"):
-        return "clang"
-    elif name.startswith("msvc") or name == "cl":
-        return "msvc"
-    elif name.startswith("clang-cl"):
-        return "clang-cl" # Silence the failure warning.
-    print("WARNING: Unknown compiler detected ({}). Normalization failed. Usage of this compiler may have unintended side-effects.".format(name))
-    return name
+    normalized = _normalizeCompilerName(name)
+    if normalized is None:
+        _warnUnknownCompiler(name)
+        return name
+    return normalized
 
 def getCompiler(env):
     """ Gets the compiler, along with its predicted type.
@@ -43,60 +160,125 @@ def getCompiler(env):
     """
 
     # Check for system overrides.
-    if (env["systemCompiler"] == True):
-        cxxAttempt = os.getenv("CXX")
-        ccAttempt = os.getenv("CC")
+    if env["systemCompiler"]:
+        cxxAttempt = os.environ.get("CXX", "").strip()
+        ccAttempt = os.environ.get("CC", "").strip()
 
-        if (cxxAttempt != None and cxxAttempt.strip() != ""): env["CXX"] = cxxAttempt
-        if (ccAttempt != None and ccAttempt.strip() != ""): env["CC"] = ccAttempt
+        if cxxAttempt: env["CXX"] = cxxAttempt
+        if ccAttempt: env["CC"] = ccAttempt
     # now, get the compiler
-    it1 = env["CXX"]
-    if (it1 == "$CC" or it1 == "cl"):
+    compiler, argType = _detectCompiler(env["CXX"])
+    if compiler not in _COMPILER_ALIASES.values():
+        # Warned about here, since _detectCompiler is cached and would only warn for the first environment
+        _warnUnknownCompiler(compiler)
+    return (compiler, argType)
+
+@functools.lru_cache(maxsize = None)
+def _detectCompiler(it1: str):
+    """
+    The part of getCompiler that only depends on CXX. Cached, so environments sharing a compiler
+    only go through detection once.
+    """
+    if it1 in ("$CC", "cl"):
         # If the compiler equals $CC, then (my condolences,) you're running MSVC.
         # According to the docs, this should be the case.
+        # This is deliberately checked before any splitting or normalization.
         return ("msvc", ZEnvFile.CompilerType.MSVC_COMPATIBLE)
 
     # if the environment variable CXX is used, this may not be a single word.
     # A manual override (such as `clang++ -target x86_64-pc-windows-gnu` would break later detection as well).
-    it2 = it1.split(" ", maxsplit=1)
+    it2, _, rest = it1.partition(" ")
+    if it2 in _COMPILER_LAUNCHERS:
+        # The compiler is the word after the launcher
+        it2 = rest.lstrip().partition(" ")[0]
 
-    if (it2[0] == "clang-cl"):
-        # clang-cl is still Clang, but takes MSVC-style input.
-        return ("clang-cl", ZEnvFile.CompilerType.MSVC_COMPATIBLE)
+    compiler = _normalizeCompilerName(it2) or it2
+    if compiler in ("clang-cl", "msvc"):
+        # clang-cl is still Clang, but takes MSVC-style input. Checked after normalization,
+        # so i.e. clang-cl.exe and cl.exe are caught as well.
+        return (compiler, ZEnvFile.CompilerType.MSVC_COMPATIBLE)
 
     # For undefined cases, we'll assume it's a POSIX-compatible compiler.
     # (Note that this doesn't care what the target system is. This is just to detect the compiler being used,
     # and by extension which arguments to use)
-    return (normalizeCompilerName(it2[0]), ZEnvFile.CompilerType.POSIX)
+    return (compiler, ZEnvFile.CompilerType.POSIX)
+
 
+# (LUNASCONS_DEBUG, LUNASCONS_CACHE_DIR, custom variables) -> Variables
+_VARIABLES_CACHE = {}
+
+def _buildVariables(customVariables):
+    """
+    Builds the Variables used by getEnvironment. The result is cached, so environments
+    created with the same custom variables share a single Variables object.
+    """
+    defaultDebug = _envbool("LUNASCONS_DEBUG")
+    defaultCacheDir = os.getenv("LUNASCONS_CACHE_DIR", "")
+    key = (defaultDebug, defaultCacheDir, tuple(repr(variable) for variable in customVariables or []))
+    if key in _VARIABLES_CACHE:
+        return _VARIABLES_CACHE[key]
+
+    import SCons.Script as Script
+    from SCons.Script import BoolVariable
 
-def getEnvironment(defaultDebug: bool = True, libraries: bool = True, stdlib: str = "c++17", useSan = True, customVariables = None):
     variables = Script.Variables()
     variables.AddVariables(
-        BoolVariable("debug", "Build with the debug flag and reduced optimization. `export LUNASCONS_DEBUG=true` to default debug to true", os.getenv("LUNASCONS_DEBUG", "False").lower() in ["true", "1", "yes"]),
+        BoolVariable("debug", "Build with the debug flag and reduced optimization. `export LUNASCONS_DEBUG=true` to default debug to true", defaultDebug),
         BoolVariable("systemCompiler", "Whether to use CXX/CC from the environment variables.", True),
         ("profile", "Which profile to use for Conan, if Conan is enabled", "default"),
         ("settings", "Settings for Conan.", None),
         ("options", "Options for Conan", None),
         ("buildDir", "Build directory. Defaults to build/. This variable CANNOT be empty", "build/"),
         ("dynamic", "(Windows only!) Whether to use /MT or /MD. False for MT, true for MD", False),
-        BoolVariable("coverage", "Adds the --coverage option", False)
+        BoolVariable("coverage", "Adds the --coverage option", False),
+        BoolVariable("ccache", "Prefix compiler invocations with ccache when available.", True),
+        ("cacheDir", "Shared SCons derived-file cache directory. `export LUNASCONS_CACHE_DIR=...` to set a default", defaultCacheDir),
+        ("sanitizers", "Comma separated sanitizers (-fsanitize=...) to use in debug builds, if useSan is enabled. Empty to disable", "undefined"),
+        BoolVariable("ninja", "Generate build.ninja, and let ninja run the build. Requires SCons 4.2 and the ninja Python package", False),
+        BoolVariable("fastDecider", "Use the MD5-timestamp decider and implicit cache. Disable on filesystems with unreliable timestamps", True)
     )
 
     if (customVariables != None):
-        if (type(customVariables) is not list):
-            raise RuntimeError("customVariables has to be a list");
         for variable in customVariables:
             variables.Add(variable)
 
-    envVars = {
-        "PATH": os.environ["PATH"]
-    }
-    if "TEMP" in os.environ:
-        envVars["TEMP"] = os.environ["TEMP"]
+    _VARIABLES_CACHE[key] = variables
+    return variables
+
+_MINGW_TOOL = None
+
+def _mingwTool():
+    """
+    Returns the MinGW tool. Constructing a Tool searches for and imports the tool module,
+    so it's only done once, and reused for any subsequent environments.
+    """
+    global _MINGW_TOOL
+    if _MINGW_TOOL is None:
+        from SCons.Script import Tool
+        _MINGW_TOOL = Tool("mingw")
+    return _MINGW_TOOL
+
+# System environment variables passed on to the build commands, if set
+_FORWARDED_ENV_VARS = ("PATH", "TEMP", "TERM")
+
+def getEnvironment(defaultDebug: bool = True, libraries: bool = True, stdlib: str = "c++17", useSan = True, customVariables = None,
+                   useCcache = True, cacheDir: str = None, fastDecider: bool = True):
+    import SCons.Script as Script
+    from SCons.Script import Environment
+
+    if libraries is not True:
+        # Logged rather than a DeprecationWarning, which Python hides for code run by SCons
+        _log.warning("getEnvironment's libraries parameter has no effect, and will be removed")
+
+    if (customVariables != None):
+        if (type(customVariables) is not list):
+            raise RuntimeError("customVariables has to be a list");
+    variables = _buildVariables(customVariables)
+
+    envVars = {key: os.environ[key] for key in _FORWARDED_ENV_VARS if os.environ.get(key)}
 
     tools = []
-    if "windows" in platform.platform().lower():
+    if _IS_WINDOWS:
         if "CXX" in os.environ and os.environ["CXX"] in ["clang++", "g++"]:
             tools.append("mingw") # Preliminary MinGW mitigation
         else:
@@ -105,59 +287,103 @@ def getEnvironment(defaultDebug: bool = True, libraries: bool = True, stdlib: st
     env = Environment(variables = variables,
                       ENV = envVars, tools = tools)
 
+    if fastDecider and env["fastDecider"]:
+        # Only hash files whose timestamp changed, and cache implicit dependencies
+        # (i.e. scanned #includes) between builds. Command line options take priority
+        # over SetOption, so these can still be overridden (i.e. --implicit-deps-changed)
+        env.Decider("MD5-timestamp")
+        Script.SetOption("implicit_cache", 1)
+        Script.SetOption("max_drift", 1)
+
+    # Only replaces SCons' default of 1, so -j (or an earlier SetOption in the
+    # SConstruct) is kept. The ninja tool reads it too, for ninja's -j and local_pool.
+    jobs = os.cpu_count() or 1
+    if Script.GetOption("num_jobs") == 1 and jobs > 1:
+        Script.SetOption("num_jobs", jobs)
+        print("Running {} jobs".format(jobs))
+
+    if env["ninja"]:
+        # SCons writes build.ninja and then runs ninja on it (unless --disable-execute-ninja
+        # is passed). Later builds can run ninja directly, and skip SCons' dependency scan.
+        env.EnsureSConsVersion(4, 2, 0)
+        Script.SetOption("experimental", "ninja")
+        env.Tool("ninja")
+        print("Generating build.ninja, and building with ninja")
+
     (compiler, argType) = getCompiler(env)
     print("Detected compiler: {}. Running debug: {}".format(compiler, env["debug"]))
 
-    if "TERM" in os.environ:
-        env["ENV"]["TERM"] = os.environ["TERM"]
-
-    if (env["PLATFORM"] == "win32"
-            and compiler != "clang-cl"
-            and compiler != "msvc"):
+    # clang-cl and MSVC are the only compilers that don't need MinGW on Windows
+    isMsvcFamily = compiler in ("clang-cl", "msvc")
+    if env["PLATFORM"] == "win32" and not isMsvcFamily:
         print("Forcing MinGW mode")
         # We also need to normalize the compiler afterwards.
         # MinGW forces GCC
         CXX = env["CXX"]
         CC = env["CC"]
-        Tool("mingw")(env)
+        _mingwTool()(env)
         env["CXX"] = CXX
         env["CC"] = CC
 
+    # Done after compiler detection, so getCompiler sees the compiler rather than ccache.
+    if useCcache and env["ccache"] and argType == ZEnvFile.CompilerType.POSIX:
+        launcher = next((name for name in _COMPILER_LAUNCHERS if env.WhereIs(name)), None)
+        if launcher is not None:
+            print("Using " + launcher)
+            for var in ("CXX", "CC"):
+                # CXX may already be prefixed from the environment (i.e. CXX="ccache g++")
+                if env[var].partition(" ")[0] not in _COMPILER_LAUNCHERS:
+                    env[var] = launcher + " " + env[var]
+            env["ENV"].update((key, value) for key, value in os.environ.items()
+                              if key.startswith(("CCACHE_", "SCCACHE_")))
+            # SCons doesn't forward these, and both use them to find their config and cache
+            env["ENV"].update((key, os.environ[key]) for key in ("HOME", "XDG_CACHE_HOME", "XDG_CONFIG_HOME")
+                              if key in os.environ and key not in env["ENV"])
+
     path = env["buildDir"]
     if (path == ""):
         raise RuntimeError("buildDir cannot be empty.")
     print("Building in {}".format(path))
 
-    compileFlags = ""
-
-    if (argType == ZEnvFile.CompilerType.POSIX):
-        compileFlags += "-std=" + stdlib + " -pedantic -Wall -Wextra -Wno-c++11-narrowing"
-        if env["debug"] == True:
-            compileFlags += " -g -O0 "
-            if env["coverage"] == True:
-                compileFlags += " --coverage "
-                env.Append(LINKFLAGS=["--coverage"])
+    flagKey = (argType, bool(env["debug"]), bool(env["dynamic"]), bool(env["coverage"]))
+    baseCompileFlags, baseLinkFlags = _FLAG_TABLE.get(flagKey) or _buildFlags(*flagKey)
+    std = ("-std=" if argType == ZEnvFile.CompilerType.POSIX else "/std:") + stdlib
+    compileFlags = [std, *baseCompileFlags]
+    linkFlags = list(baseLinkFlags)
 
-        else:
-            compileFlags += " -O3 "
-    else:
-        # Note to self: /W4 and /Wall spews out warnings for dependencies. Roughly equivalent to -Wall -Wextra on stereoids
-        compileFlags += "/std:" + stdlib + " /W3 /EHsc /FS "
-        if env["debug"] == True:
-            env.Append(LINKFLAGS = ["/DEBUG"])
-            env.Append(CXXFLAGS=["/MTd" if not env["dynamic"] else "MDd", "/Zi"])
-        else:
-            compileFlags += " /O2 " + ("/MT" if not env["dynamic"] else "/MD") + " "
-    env.Append(CXXFLAGS = compileFlags.split(" "))
+    sanitizers = [check.strip() for check in env["sanitizers"].split(",") if check.strip()]
+    if env["debug"] and useSan and sanitizers and env["PLATFORM"] == "win32" and compiler != "msvc":
+        # MinGW doesn't ship the sanitizer runtimes, so only undefined works, by trapping
+        # instead of reporting. The others would fail to link.
+        unsupported = [check for check in sanitizers if check != "undefined"]
+        if unsupported:
+            _log.warning("Windows detected. MinGW doesn't have the sanitizer runtimes. Ignoring sanitizers: %s",
+                         ",".join(unsupported))
+        sanitizers = [check for check in sanitizers if check == "undefined"]
+        if sanitizers:
+            _log.warning("Windows detected. MinGW doesn't have libubsan. Using crash instead (-fsanitize-undefined-trap-on-error)")
+            compileFlags.append("-fsanitize-undefined-trap-on-error")
 
-    zEnv = ZEnvFile.ZEnv(env, path, env["debug"], compiler, argType, variables)
-    if env["debug"] == True and useSan:
+    if env["debug"] and useSan and sanitizers:
+        # The checks are passed as-is (i.e. undefined, or address,undefined).
+        # Failing on the first error rather than continuing, and keeping frame pointers,
+        # makes the reports usable in CI.
+        checks = ",".join(sanitizers)
         if argType == ZEnvFile.CompilerType.POSIX:
-            zEnv.environment.Append(CXXFLAGS = ["-fsanitize=undefined"])
+            compileFlags.extend(["-fsanitize=" + checks, "-fno-sanitize-recover=" + checks,
+                                 "-fno-omit-frame-pointer"])
 
         if env["PLATFORM"] != "win32":
-            zEnv.environment.Append(LINKFLAGS=["-fsanitize=undefined"])
-        elif (compiler != "msvc"):
-            print("WARNING: Windows detected. MinGW doesn't have libubsan. Using crash instead (-fsanitize-undefined-trap-on-error)")
-            zEnv.environment.Append(CXXFLAGS = ["-fsanitize-undefined-trap-on-error"])
+            linkFlags.append("-fsanitize=" + checks)
+
+    # One Append for everything, rather than one per flag category
+    env.Append(CXXFLAGS = compileFlags, LINKFLAGS = linkFlags)
+
+    zEnv = ZEnvFile.ZEnv(env, path, env["debug"], compiler, argType, variables)
+    if env["debug"] and useSan:
+        zEnv.sanitizers = sanitizers
+    # Only enabled if one of them is set, so builds without a cache stay quiet
+    cachePath = cacheDir or env.subst(env["cacheDir"]) or os.environ.get("SCONS_CACHE")
+    if cachePath:
+        zEnv.withCache(cachePath)
     return zEnv
@@ -0,0 +1,29 @@
+import os
+import sys
+import importlib
+import unittest
+
+# The repository is the package itself (it's usually cloned into site_scons/),
+# so it's imported through its parent directory. SCons isn't needed for this.
+_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(_REPO))
+lunascons = importlib.import_module(os.path.basename(_REPO))
+
+class TestNormalizeCompilerName(unittest.TestCase):
+    def test_exact_names(self):
+        self.assertEqual(lunascons.normalizeCompilerName("g++"), "gcc")
+        self.assertEqual(lunascons.normalizeCompilerName("clang++"), "clang")
+        self.assertEqual(lunascons.normalizeCompilerName("cl"), "msvc")
+
+    def test_versioned_full_paths(self):
+        self.assertEqual(lunascons.normalizeCompilerName("/usr/bin/g++-11"), "gcc")
+        self.assertEqual(lunascons.normalizeCompilerName("/usr/lib/llvm-14/bin/clang++-14"), "clang")
+        self.assertEqual(lunascons.normalizeCompilerName("/usr/bin/clang-cl-14"), "clang-cl")
+        self.assertEqual(lunascons.normalizeCompilerName("C:\\LLVM\\bin\\clang-cl.exe"), "clang-cl")
+        self.assertEqual(lunascons.normalizeCompilerName("C:\\VS\\bin\\cl.exe"), "msvc")
+
+    def test_cl_isnt_a_prefix(self):
+        self.assertIsNone(lunascons._normalizeCompilerName("/usr/bin/clazy"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,38 @@
-import SCons
-import SCons.SConf
 import SCons.Script as Script
 
 from SCons.Script import Configure
 from SCons.SConf import CheckContext
 
-import platform
+import os
+import re
+import json
+import sys
+import hashlib
+
+# platform.system() asks the OS (uname) on every call; sys.platform is fixed at build time
+_IS_DARWIN = sys.platform == "darwin"
+
+def _compileMarker(context: CheckContext, source: str, marker: str):
+    """
+    Compiles source, which is expected to fail with `#error <marker>=<value>`,
+    and returns the value, or None if no single value could be found.
+
+    The compiler output is read back from the configure log, so this needs
+    Configure to have one (the default).
+    """
+    sconf = context.sconf
+    if sconf.logstream is None:
+        return None
+    start = sconf.logstream.tell()
+    context.TryCompile(source, ".cpp")
+    sconf.logstream.flush()
+    with open(sconf.logfile.get_internal_path(), "r", errors = "replace") as f:
+        f.seek(start)
+        output = f.read()
+    # Only matches diagnostics (GCC/Clang: "error: #error ...", MSVC: "error C1189: #error: ..."),
+    # not the copy of the source file SCons writes to the log.
+    values = set(re.findall(r"error(?::| C\d+:).*?" + re.escape(marker) + r"=([\w+-]+)", output))
+    return values.pop() if len(values) == 1 else None
 
 def detectStdlib(context: CheckContext, zenv):
     context.Message("Detecting stdlib... ")
@@ -13,6 +40,26 @@ def detectStdlib(context: CheckContext, zenv):
         context.Result("Detected stdlib (cached): " + zenv.stdlib)
         return zenv.stdlib
 
+    # All three checks in one compile. The three separate probes below are only used
+    # if the marker can't be found: if there's no log, or if SCons' own configure cache
+    # answered the probe, in which case the compiler output isn't logged again.
+    markerProbe = """
+    #include <ciso646>
+    #if defined(__GLIBCXX__)
+    #error LUNASCONS_STDLIB=libstdc++
+    #elif defined(_LIBCPP_VERSION)
+    #error LUNASCONS_STDLIB=libc++
+    #elif defined(_MSVC_STL_VERSION)
+    #error LUNASCONS_STDLIB=msvc-stl
+    #endif
+    int main() {}
+    """
+    stdlib = _compileMarker(context, markerProbe, "LUNASCONS_STDLIB")
+    if stdlib is not None:
+        zenv.stdlib = stdlib
+        context.Result(stdlib)
+        return stdlib
+
     cisoProbe = """
     #include <ciso646>
     int main() {}
@@ -81,6 +128,58 @@ def detectFilesystem(context: CheckContext, zenv):
     if not zenv.stdlib:
         detectStdlib(context, zenv);
 
+    # Every check below in one compile: LUNASCONS_FS=<supported>_<needs linking>
+    markerProbe = """
+    #include <ciso646>
+    #if defined(__GLIBCXX__)
+    #if defined(_GLIBCXX_RELEASE) && _GLIBCXX_RELEASE >= 9
+    #error LUNASCONS_FS=1_0
+    #elif defined(_GLIBCXX_RELEASE) && _GLIBCXX_RELEASE >= 8
+    #error LUNASCONS_FS=1_1
+    #else
+    #error LUNASCONS_FS=0_1
+    #endif
+    #elif defined(_LIBCPP_VERSION)
+    #if _LIBCPP_VERSION >= 9000
+    #error LUNASCONS_FS=1_0
+    #elif _LIBCPP_VERSION >= 7000
+    #error LUNASCONS_FS=1_1
+    #else
+    #error LUNASCONS_FS=0_1
+    #endif
+    #elif defined(_MSVC_STL_UPDATE) && _MSVC_STL_UPDATE >= 201803
+    #error LUNASCONS_FS=1_0
+    #else
+    #error LUNASCONS_FS=0_0
+    #endif
+    """
+    marker = _compileMarker(context, markerProbe, "LUNASCONS_FS")
+    if marker is not None:
+        supported, _, link = marker.partition("_")
+        supportsFilesystem, needsLink = int(supported), int(link)
+        if zenv.stdlib == "libc++" and _IS_DARWIN:
+            # Apple Clang disallows linking the library.
+            needsLink = 0
+        context.Result("Supports filesystem? {}. Needs to link a library? {}."
+                       .format(supportsFilesystem, needsLink))
+        return (supportsFilesystem, needsLink)
+
+    # Modern toolchains all support <filesystem> without linking anything,
+    # so they don't need the detailed probes below.
+    modernProbe = """
+    #include <ciso646>
+    #if (defined(_GLIBCXX_RELEASE) && _GLIBCXX_RELEASE >= 9) || \\
+        (defined(_LIBCPP_VERSION) && _LIBCPP_VERSION >= 9000) || \\
+        (defined(_MSVC_STL_UPDATE) && _MSVC_STL_UPDATE >= 201803)
+    int main() {}
+    #else
+    #error "Not a modern toolchain"
+    #endif
+    """
+    if context.TryCompile(modernProbe, ".cpp"):
+        context.Result("Supports filesystem? 1. Needs to link a library? 0.")
+        return (1, 0)
+
     supportsFilesystem = False
     needsLink = False
 
@@ -105,7 +204,7 @@ def detectFilesystem(context: CheckContext, zenv):
     elif zenv.stdlib == "libc++":
         # libc requires an exception for mac:
 
-        if (platform.system() == "Darwin"):
+        if _IS_DARWIN:
             # macOS
             # Apple Clang disallows linking the library.
             needsLink = False
@@ -148,25 +247,119 @@ def detectFilesystem(context: CheckContext, zenv):
 
     return (supportsFilesystem, needsLink)
 
+# The tests ConfigContext caches the results of. See ConfigContext.isCacheable
+_CACHEABLE_TESTS = (detectStdlib, detectFilesystem)
+
+# How many environments' results configure_cache.json keeps
+_MAX_CACHED_ENVIRONMENTS = 16
+
 class ConfigContext:
     def __init__(self, zenv):
         self.zenv = zenv;
+        self.config = None
+        self.tests = {}
+        self.results = {}
+        # Whether results has anything configure_cache.json doesn't
+        self.changed = False
+        self.cachePath = os.path.join(zenv.path, "configure_cache.json")
 
     def __enter__(self):
         print("Configuring...")
-        self.config = Configure(self.zenv.environment)
         # This adds some pre-added tests
-        self.config.AddTests({
+        self.addTests({
             "detectStdlib": detectStdlib,
             "detectFilesystem": detectFilesystem
         });
+        self.cacheKey = self.hashEnvironment()
+        self.results = self.loadCache().get(self.cacheKey, {})
+        self.changed = False
         return self
 
+    def hashEnvironment(self):
+        """
+        Hashes everything that can affect the result of a test: the compiler
+        and the flags it's invoked with. Cached results are discarded when
+        this changes.
+        """
+        flags = self.zenv.environment.subst("$CXX $CXXFLAGS $CCFLAGS $CPPFLAGS $_CPPDEFFLAGS $_CPPINCFLAGS "
+                                            "$LINKFLAGS $_LIBDIRFLAGS $_LIBFLAGS")
+        return hashlib.blake2b("{}|{}|{}".format(self.zenv.compiler, self.compilerIdentity(), flags).encode(),
+                               digest_size = 16).hexdigest()
+
+    def compilerIdentity(self):
+        """
+        Identifies the compiler binary by its resolved path, size and modification time,
+        so upgrading the compiler invalidates the cache even if its name stays the same.
+        Cheaper than running `$CXX --version`, which would spawn the compiler every run.
+        """
+        from . import _COMPILER_LAUNCHERS
+        env = self.zenv.environment
+        words = env.subst("$CXX").split()
+        while len(words) > 1 and words[0] in _COMPILER_LAUNCHERS:
+            words.pop(0)
+        if not words:
+            return ""
+        executable = env.WhereIs(words[0]) or words[0]
+        try:
+            stat = os.stat(executable)
+        except OSError:
+            return executable
+        return "{}:{}:{}".format(executable, stat.st_size, stat.st_mtime_ns)
+
+    def loadCache(self):
+        """
+        Returns the cached results for every environment, keyed by hashEnvironment().
+        """
+        # --config=force is SCons' own way of saying "re-run everything"
+        from . import _envbool
+        if Script.GetOption("config") == "force" or _envbool("LUNASCONS_NO_PROBE_CACHE"):
+            return {}
+        return self.readCache()
+
+    def readCache(self):
+        try:
+            with open(self.cachePath, "r") as f:
+                cache = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+        environments = cache.get("environments")
+        return environments if isinstance(environments, dict) else {}
+
+    def getConfig(self):
+        """
+        Returns SCons' Configure context. It's only created the first time a
+        test isn't cached, which means fully cached runs never start it.
+        """
+        if self.config is None:
+            self.config = Configure(self.zenv.environment, custom_tests = self.tests)
+        return self.config
+
     def addTest(self, name: str, function):
-        self.config.AddTest(name, function)
+        self.tests[name] = function
+        if self.config is not None:
+            self.config.AddTest(name, function)
 
     def addTests(self, testMap):
-        self.config.AddTests(testMap)
+        for name, function in testMap.items():
+            self.addTest(name, function)
+
+    def isCacheable(self, name: str):
+        """
+        Only the built-in tests are cached. They have no side effects beyond setting
+        zenv.stdlib, which is restored on a cache hit. SCons' Check* tests and user
+        callbacks are always run, as they may modify the environment (i.e. CheckLib
+        adding to LIBS).
+        """
+        return self.tests.get(name) in _CACHEABLE_TESTS
+
+    def resultKey(self, name: str, args, kwargs):
+        # The ZEnv is already covered by the cache key.
+        try:
+            return json.dumps([name, ["$zenv" if arg is self.zenv else arg for arg in args], kwargs],
+                              sort_keys = True)
+        except TypeError:
+            # Non-serializable arguments; the test isn't cached
+            return None
 
     def test(self, name: str, *args, **kwargs):
         """
@@ -174,6 +367,9 @@ class ConfigContext:
         with a supplied callback.
         The callback has to be a named argument, or the call being:
         test("myNewTest", callback = someFunction)
+
+        Results of the built-in tests are cached in the build directory, and reused
+        until the compiler or flags change. Run with --config=force to ignore the cache.
         """
         callback = None
         if "callback" in kwargs:
@@ -182,19 +378,39 @@ class ConfigContext:
 
         # See if the callback can be set
         if callback is not None:
-            self.config.AddTest(name, callback)
+            self.addTest(name, callback)
+
+        key = self.resultKey(name, args, kwargs) if self.isCacheable(name) else None
+        if key is not None and key in self.results:
+            result = self.results[key]
+            print("{} (cached): {}".format(name, result))
+            if name == "detectStdlib" and args and args[0] is self.zenv:
+                # What running the test would have done
+                self.zenv.stdlib = result
+            return result
+
+        config = self.getConfig()
         # Finally, before running, make sure the test exists,
         # regardless of whether it was just added or not
-        if not hasattr(self.config, name):
+        if not hasattr(config, name):
             raise RuntimeError("Test not registered: " + name)
-        return getattr(self.config, name)(*args, **kwargs)
+        result = getattr(config, name)(*args, **kwargs)
+        if key is not None:
+            try:
+                json.dumps(result)
+                if self.results.get(key, self) != result:
+                    self.results[key] = result
+                    self.changed = True
+            except TypeError:
+                pass
+        return result
 
     def configureFilesystem(self):
         """
         This method configures the filesystem based on my preferred standard.
         """
-        self.config.detectStdlib(self.zenv)
-        (supportsFilesystem, needsLink) = self.config.detectFilesystem(self.zenv)
+        self.zenv.stdlib = self.test("detectStdlib", self.zenv)
+        (supportsFilesystem, needsLink) = self.test("detectFilesystem", self.zenv)
 
         if not supportsFilesystem:
             raise RuntimeError("This build doesn't support filesystem")
@@ -209,5 +425,23 @@ class ConfigContext:
 
     def __exit__(self, type, value, traceback):
         print("Configuration done")
-        self.config.Finish()
-        self.config = None
+        if self.config is not None:
+            # With --config=force, SCons runs the tests on a clone of the environment,
+            # and only the returned environment has their changes (i.e. LIBS from CheckLib)
+            self.zenv.environment = self.config.Finish()
+            self.config = None
+        # Nothing new to store, or the results can't be trusted (the body raised, or
+        # scons -n, -c or -h didn't actually run the tests)
+        if not self.changed or value is not None \
+                or any(Script.GetOption(option) for option in ("no_exec", "clean", "help")):
+            return
+        os.makedirs(self.zenv.path, exist_ok = True)
+        # Re-read, so results other environments wrote since __enter__ are kept
+        environments = self.readCache()
+        # Moved to the end, so the least recently used environments are dropped first
+        environments.pop(self.cacheKey, None)
+        environments[self.cacheKey] = self.results
+        while len(environments) > _MAX_CACHED_ENVIRONMENTS:
+            del environments[next(iter(environments))]
+        with open(self.cachePath, "w") as f:
+            json.dump({"environments": environments}, f)